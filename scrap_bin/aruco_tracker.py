@@ -2,26 +2,64 @@ import cv2
 import numpy as np
 import asyncio
 import websockets
-import json
+from websockets import broadcast as ws_broadcast
+import orjson
+import math
 import time
+import signal
 import mediapipe as mp
 
+_RAD2DEG = 180.0 / math.pi
+
+def rvec_to_euler_zyx(rvecs):
+    """(N,3) Rodrigues vectors -> (N,3) Euler angles in degrees, without building R"""
+    theta = np.linalg.norm(rvecs, axis=1)
+    kx, ky, kz = (rvecs / np.where(theta < 1e-8, 1.0, theta)[:, None]).T  # Identity when theta ~ 0
+    c, s = np.cos(theta), np.sin(theta)
+    C = 1 - c
+    # Only the five matrix entries the angles need; R21/R22 are negated to map
+    # the y-up IPPE pose back to the y-down marker frame
+    R00 = kx * kx * C + c
+    R10 = kx * ky * C + kz * s
+    R20 = kx * kz * C - ky * s
+    R21 = -(ky * kz * C + kx * s)
+    R22 = -(kz * kz * C + c)
+    # All three angles from a single arctan2 over (3,N)
+    return np.arctan2(
+        np.stack([R21, -R20, R10]),
+        np.stack([R22, np.hypot(R21, R22), R00])
+    ).T * _RAD2DEG
+
 class CompactTracker:
     def __init__(self):
         # Camera and basic setup
         self.cap = cv2.VideoCapture(0)
         self.flip_camera = False
+        self.debug_display = False  # Show the annotated camera window
+        self.draw_overlay = self.debug_display  # Nobody sees the annotations without the window
+        self.running = False
         self.clients = set()
         
         # ArUco setup
         self.aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)
         self.detector = cv2.aruco.ArucoDetector(self.aruco_dict, cv2.aruco.DetectorParameters())
-        self.camera_matrix = np.array([[800, 0, 320], [0, 800, 240], [0, 0, 1]], dtype=float)
-        self.dist_coeffs = np.zeros((4,1))
+        self.camera_matrix = np.array([[800, 0, 320], [0, 800, 240], [0, 0, 1]], dtype=np.float32)
+        self.dist_coeffs = np.zeros((4,1), dtype=np.float32)
         self.marker_length = 0.05
+        # Marker corners, built once instead of per marker per frame, in the
+        # y-up order IPPE_SQUARE requires
+        self._obj_pts = np.array([[-0.025, 0.025, 0], [0.025, 0.025, 0], [0.025, -0.025, 0], [-0.025, -0.025, 0]],
+                                 dtype=np.float32).reshape(-1, 1, 3)
         
         # MediaPipe setup
-        self.hands = mp.solutions.hands.Hands(max_num_hands=2, min_detection_confidence=0.7)
+        # Lite landmark model; palm detection only re-runs when tracking is lost
+        self.hands = mp.solutions.hands.Hands(
+            max_num_hands=2, min_detection_confidence=0.7,
+            min_tracking_confidence=0.5, model_complexity=0
+        )
+        self.hand_input_width = 256  # MediaPipe downsizes internally anyway
+        self._small_buf = None  # Reused resize / RGB buffers for the hand input
+        self._rgb_buf = None
         self.mp_drawing = mp.solutions.drawing_utils
         
     def detect_markers(self, frame):
@@ -30,41 +68,47 @@ class CompactTracker:
         h, w = frame.shape[:2]  # Get frame dimensions
         
         if ids is not None:
-            for i, marker_id in enumerate(ids.flatten()):
-                # Calculate marker center in screen coordinates
-                center = np.mean(corners[i][0], axis=0)
-                center_x_norm = center[0] / w  # Normalize to 0-1
-                center_y_norm = center[1] / h  # Normalize to 0-1
-                
-                # Existing pose estimation...
+            posed_ids, posed_corners, tvecs, rvecs = [], [], [], []
+            for marker_id, marker_corners in zip(ids.flatten().tolist(), corners):
                 success, rvec, tvec = cv2.solvePnP(
-                    np.array([[-0.025, -0.025, 0], [0.025, -0.025, 0], [0.025, 0.025, 0], [-0.025, 0.025, 0]], dtype=np.float32),
-                    corners[i].reshape(-1, 2), self.camera_matrix, self.dist_coeffs
+                    self._obj_pts, marker_corners.reshape(-1, 1, 2).astype(np.float32, copy=False),
+                    self.camera_matrix, self.dist_coeffs, flags=cv2.SOLVEPNP_IPPE_SQUARE
                 )
                 if success:
-                    R, _ = cv2.Rodrigues(rvec.flatten())
-                    markers[int(marker_id)] = {
-                        'id': int(marker_id),
-                        'position': {
-                            'x': float(tvec[0]), 
-                            'y': float(tvec[1]), 
-                            'z': float(tvec[2])
-                        },
-                        'screen_position': {  # Add screen coordinates
-                            'x': float(center_x_norm),
-                            'y': float(center_y_norm)
-                        },
-                        'rotation': {
-                            'x': float(np.arctan2(R[2,1], R[2,2]) * 180/np.pi),
-                            'y': float(np.arctan2(-R[2,0], np.sqrt(R[2,1]**2 + R[2,2]**2)) * 180/np.pi),
-                            'z': float(np.arctan2(R[1,0], R[0,0]) * 180/np.pi)
-                        }
+                    posed_ids.append(marker_id)
+                    posed_corners.append(marker_corners)
+                    tvecs.append(tvec)
+                    rvecs.append(rvec)
+            
+            if posed_ids:
+                rotations = rvec_to_euler_zyx(np.stack(rvecs).reshape(-1, 3)).tolist()
+                # Marker centers in normalized (0-1) screen coordinates
+                centers = (np.stack(posed_corners)[:, 0].mean(axis=1) / (w, h)).tolist()
+                
+                for marker_id, t, c, r in zip(posed_ids, np.stack(tvecs).reshape(-1, 3).tolist(), centers, rotations):
+                    markers[marker_id] = {
+                        'id': marker_id,
+                        'position': {'x': t[0], 'y': t[1], 'z': t[2]},
+                        'screen_position': {'x': c[0], 'y': c[1]},  # Add screen coordinates
+                        'rotation': {'x': r[0], 'y': r[1], 'z': r[2]}
                     }
-            cv2.aruco.drawDetectedMarkers(frame, corners)
+            if self.draw_overlay:
+                cv2.aruco.drawDetectedMarkers(frame, corners)
         return markers
 
     def detect_hands(self, frame):
-        results = self.hands.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        # Landmarks are normalized, so a smaller (same aspect) input is safe
+        h, w = frame.shape[:2]
+        size = (self.hand_input_width, h * self.hand_input_width // w)
+        if self._small_buf is None or self._small_buf.shape[1::-1] != size:
+            self._small_buf = np.empty((size[1], size[0], 3), dtype=np.uint8)
+            self._rgb_buf = np.empty_like(self._small_buf)
+        
+        cv2.resize(frame, size, dst=self._small_buf, interpolation=cv2.INTER_AREA)
+        self._rgb_buf.flags.writeable = True
+        cv2.cvtColor(self._small_buf, cv2.COLOR_BGR2RGB, dst=self._rgb_buf)
+        self._rgb_buf.flags.writeable = False  # Lets MediaPipe skip its own copy
+        results = self.hands.process(self._rgb_buf)
         hands_data = []
         
         if results.multi_hand_landmarks:
@@ -76,7 +120,8 @@ class CompactTracker:
                     'landmarks': [{'x': lm.x, 'y': lm.y, 'z': lm.z} for lm in landmarks.landmark]
                 })
                 # Draw on camera feed
-                self.mp_drawing.draw_landmarks(frame, landmarks, mp.solutions.hands.HAND_CONNECTIONS)
+                if self.draw_overlay:
+                    self.mp_drawing.draw_landmarks(frame, landmarks, mp.solutions.hands.HAND_CONNECTIONS)
         
         return hands_data
 
@@ -85,20 +130,27 @@ class CompactTracker:
         try:
             await websocket.wait_closed()
         finally:
-            self.clients.remove(websocket)
+            self.clients.discard(websocket)
 
-    async def broadcast(self, data):
+    def broadcast(self, data):
         if self.clients:
-            message = json.dumps(data)
-            for client in list(self.clients):
-                try:
-                    await client.send(message)
-                except:
-                    self.clients.discard(client)
+            # Decoded to str so it still goes out as a text frame for the JSON.parse clients
+            message = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()  # Markers are keyed by int id
+            # No awaits while iterating, so the set can't change under us - no snapshot needed
+            ws_broadcast(self.clients, message)
+
+    def stop(self, *_):
+        self.running = False
 
     async def track(self):
-        while True:
-            ret, frame = self.cap.read()
+        # Ctrl+C ends the loop cleanly instead of polling the GUI for 'q'
+        signal.signal(signal.SIGINT, self.stop)
+        self.running = True
+        loop = asyncio.get_running_loop()
+        while self.running:
+            # cap.read() blocks until the next frame and paces the loop; run it
+            # off the event loop so websocket IO keeps flowing meanwhile
+            ret, frame = await loop.run_in_executor(None, self.cap.read)
             if not ret:
                 break
 
@@ -109,23 +161,25 @@ class CompactTracker:
             markers = self.detect_markers(frame)
             hands = self.detect_hands(frame)
             
-            await self.broadcast({
+            self.broadcast({
                 'type': 'tracking_update',
                 'markers': markers,
                 'hands': hands,
                 'timestamp': time.time()
             })
             
-            cv2.imshow('Tracker', frame)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
-            await asyncio.sleep(0.033)
+            if self.debug_display:
+                cv2.imshow('Tracker', frame)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
         
         self.cap.release()
-        cv2.destroyAllWindows()
+        if self.debug_display:
+            cv2.destroyAllWindows()
 
     async def start(self, host='localhost', port=8765):
-        server = await websockets.serve(self.handle_client, host, port)
+        # No per-message deflate, so broadcast frames are never re-encoded per client
+        server = await websockets.serve(self.handle_client, host, port, compression=None)
         await self.track()
 
 if __name__ == "__main__":
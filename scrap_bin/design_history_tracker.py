@@ -3,6 +3,7 @@ import numpy as np
 import asyncio
 import websockets
 import json
+import orjson
 import time
 import threading
 from queue import Queue, Empty
@@ -58,15 +59,25 @@ class OptimizedTracker:
             [0, 0, 1]
         ], dtype=float)
         self.dist_coeffs = np.zeros((4,1))
+        # Marker corners and the degree factor never change, build them once
+        self._object_points = np.array([
+            [-0.025, -0.025, 0], [0.025, -0.025, 0], 
+            [0.025, 0.025, 0], [-0.025, 0.025, 0]
+        ], dtype=np.float32)
+        self._R2D = 180.0 / np.pi
         
         # Threading setup
-        self.frame_queue = Queue(maxsize=1)  # Even smaller queue for lower latency
+        # Single latest-frame slot between capture and processing (newest wins)
+        self._latest_frame = None
+        self._latest_lock = threading.Lock()
+        self._frame_event = threading.Event()
+        self.frames_dropped = 0  # Frames replaced before processing picked them up
         self.result_queue = Queue(maxsize=5)
         self.running = False
         
         # Motion detection for frame skipping
-        self.last_gray = None
-        self.motion_threshold = 2000  # Adjust based on testing
+        self.last_small = None  # 4x-downsampled grayscale center of the previous frame
+        self.motion_threshold = 2000 / 64  # Adjust based on testing (scaled for center ROI + 4x downsample)
         self.frame_skip_counter = 0
         self.max_frame_skip = 2  # Skip at most 2 frames during fast motion
         
@@ -74,7 +85,7 @@ class OptimizedTracker:
         self.marker_velocities = {}
         self.prediction_alpha = 0.3  # Smoothing factor for velocity estimation
         
-        # History tracking
+        # History tracking - {marker_id: {frame: (x, y, z, rx, ry, rz)}}, config joined on export
         self.design_history = {}
         self.last_states = {}
         self.frame_count = 0
@@ -112,12 +123,14 @@ class OptimizedTracker:
             # Motion-based frame skipping
             should_process = True
             if frame_count > 1:  # Skip first frame for motion detection
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                # Markers rarely sit in the image corners, only watch the center
+                h, w = frame.shape[:2]
+                gray = cv2.cvtColor(frame[h//4:3*h//4, w//4:3*w//4], cv2.COLOR_BGR2GRAY)
+                small = cv2.resize(gray, None, fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA)
                 
-                if self.last_gray is not None:
-                    # Calculate motion
-                    diff = cv2.absdiff(self.last_gray, gray)
-                    motion_amount = np.sum(diff)
+                if self.last_small is not None:
+                    # Calculate motion (SAD on the downsampled frame, 16x fewer pixels)
+                    motion_amount = cv2.norm(small, self.last_small, cv2.NORM_L1)
                     
                     # Skip frames during high motion to reduce processing load
                     if motion_amount > self.motion_threshold:
@@ -127,29 +140,30 @@ class OptimizedTracker:
                     else:
                         self.frame_skip_counter = 0
                 
-                self.last_gray = gray
+                self.last_small = small
             
             if should_process:
-                # Drop old frames if queue is full
-                while not self.frame_queue.empty():
-                    try:
-                        self.frame_queue.get_nowait()
-                    except Empty:
-                        break
-                
-                try:
-                    self.frame_queue.put_nowait((time.time(), frame))
-                except:
-                    pass  # Queue full, drop frame
-            
-            time.sleep(0.003)  # Reduced delay for faster capture
+                # Replace any unprocessed frame with the newest one
+                with self._latest_lock:
+                    if self._latest_frame is not None:
+                        self.frames_dropped += 1
+                    self._latest_frame = (time.time(), frame)
+                self._frame_event.set()
 
     def process_thread(self):
         """Dedicated thread for marker detection"""
         print("🔍 Processing thread started")
         while self.running:
             try:
-                timestamp, frame = self.frame_queue.get(timeout=0.1)
+                if not self._frame_event.wait(timeout=0.1):
+                    continue
+                with self._latest_lock:
+                    item, self._latest_frame = self._latest_frame, None
+                    self._frame_event.clear()
+                if item is None:
+                    continue
+                
+                timestamp, frame = item
                 markers = self.detect_markers(frame)
                 
                 # Put result with timestamp
@@ -162,8 +176,6 @@ class OptimizedTracker:
                 except:
                     pass  # Queue full, drop result
                     
-            except Empty:
-                continue
             except Exception as e:
                 print(f"❌ Processing error: {e}")
 
@@ -175,15 +187,10 @@ class OptimizedTracker:
         
         if ids is not None:
             # Batch process all markers
-            object_points = np.array([
-                [-0.025, -0.025, 0], [0.025, -0.025, 0], 
-                [0.025, 0.025, 0], [-0.025, 0.025, 0]
-            ], dtype=np.float32)
-            
             for i, marker_id in enumerate(ids.flatten()):
                 try:
                     success, rvec, tvec = cv2.solvePnP(
-                        object_points, corners[i].reshape(-1, 2), 
+                        self._object_points, corners[i].reshape(-1, 2), 
                         self.camera_matrix, self.dist_coeffs
                     )
                     
@@ -192,8 +199,12 @@ class OptimizedTracker:
                         rvec_flat = rvec.flatten()
                         tvec_flat = tvec.flatten()
                         
-                        # Fast rotation conversion
+                        # Fast rotation conversion - all three angles from one arctan2 call
                         R, _ = cv2.Rodrigues(rvec_flat)
+                        rx, ry, rz = (np.arctan2(
+                            (R[2,1], -R[2,0], R[1,0]),
+                            (R[2,2], np.hypot(R[2,1], R[2,2]), R[0,0])
+                        ) * self._R2D).tolist()
                         markers[int(marker_id)] = {
                             'id': int(marker_id),
                             'position': {
@@ -201,11 +212,7 @@ class OptimizedTracker:
                                 'y': tvec_flat[1].item(), 
                                 'z': tvec_flat[2].item()
                             },
-                            'rotation': {
-                                'x': float(np.arctan2(R[2,1], R[2,2]) * 180/np.pi),
-                                'y': float(np.arctan2(-R[2,0], np.sqrt(R[2,1]**2 + R[2,2]**2)) * 180/np.pi),
-                                'z': float(np.arctan2(R[1,0], R[0,0]) * 180/np.pi)
-                            }
+                            'rotation': {'x': rx, 'y': ry, 'z': rz}
                         }
                 except Exception as e:
                     print(f"❌ Marker {marker_id} processing error: {e}")
@@ -260,65 +267,43 @@ class OptimizedTracker:
         
         self.last_update_time = current_time
         return predicted_markers
-    def should_update_history(self, markers):
+    def pose_changed(self, markers, pos_thr, rot_thr):
+        """True if the marker set differs or any marker moved/turned past the thresholds"""
         if len(markers) != len(self.last_states):
             return True
         
+        # A handful of dict-shaped markers - a plain loop that stops at the first change wins here
         for marker_id, data in markers.items():
-            if marker_id not in self.last_states:
+            last = self.last_states.get(marker_id)
+            if last is None:
                 return True
             
-            last = self.last_states[marker_id]
-            # Increased thresholds for fewer updates
-            pos_change = sum(abs(data['position'][k] - last['position'][k]) for k in ['x', 'y', 'z'])
-            rot_change = sum(abs(data['rotation'][k] - last['rotation'][k]) for k in ['x', 'y', 'z'])
-            
-            if pos_change > 0.015 or rot_change > 2.0:  # Higher thresholds
+            p, lp = data['position'], last['position']
+            if abs(p['x'] - lp['x']) + abs(p['y'] - lp['y']) + abs(p['z'] - lp['z']) > pos_thr:
+                return True
+            r, lr = data['rotation'], last['rotation']
+            if abs(r['x'] - lr['x']) + abs(r['y'] - lr['y']) + abs(r['z'] - lr['z']) > rot_thr:
                 return True
         return False
 
+    def should_update_history(self, markers):
+        return self.pose_changed(markers, 0.015, 2.0)  # Higher thresholds
+
     def should_broadcast(self, markers):
         """Separate check for broadcasting - can be more frequent than history"""
-        if len(markers) != len(self.last_states):
-            return True
-        
-        for marker_id, data in markers.items():
-            if marker_id not in self.last_states:
-                return True
-            
-            last = self.last_states[marker_id]
-            pos_change = sum(abs(data['position'][k] - last['position'][k]) for k in ['x', 'y', 'z'])
-            rot_change = sum(abs(data['rotation'][k] - last['rotation'][k]) for k in ['x', 'y', 'z'])
-            
-            if pos_change > 0.003 or rot_change > 0.3:  # Even lower thresholds for smoother display
-                return True
-        return False
+        return self.pose_changed(markers, 0.003, 0.3)  # Even lower thresholds for smoother display
 
     def update_history(self, markers):
         all_ids = set(markers.keys()) | set(self.last_states.keys())
         
         for marker_id in all_ids:
-            marker_id_str = str(marker_id)
-            if marker_id_str not in self.design_history:
-                self.design_history[marker_id_str] = {}
-            
-            data = markers.get(marker_id, self.last_states.get(marker_id, {
-                'position': {'x': 0, 'y': 0, 'z': 0},
-                'rotation': {'x': 0, 'y': 0, 'z': 0}
-            }))
-            
-            config = self.config['markers'].get(marker_id_str, self.config['default'])
-            
-            entry = {
-                **config,
-                "pos-rot": {
-                    "x": data['position']['x'], "y": data['position']['y'], "z": data['position']['z'],
-                    "rx": data['rotation']['x'], "ry": data['rotation']['y'], "rz": data['rotation']['z'],
-                    "s": 0.1
-                }
-            }
-            
-            self.design_history[marker_id_str][str(self.frame_count)] = entry
+            data = markers.get(marker_id, self.last_states.get(marker_id))
+            position, rotation = data['position'], data['rotation']
+            # Only the pose goes in per frame, the config is joined back in on export
+            self.design_history.setdefault(marker_id, {})[self.frame_count] = (
+                position['x'], position['y'], position['z'],
+                rotation['x'], rotation['y'], rotation['z']
+            )
         
         self.frame_count += 1
 
@@ -328,7 +313,7 @@ class OptimizedTracker:
             current_time = time.time()
             elapsed = current_time - self.fps_start_time
             fps = 30 / elapsed
-            print(f"📊 Processing FPS: {fps:.1f} | Frames: {self.frame_count} | Clients: {len(self.clients)}")
+            print(f"📊 Processing FPS: {fps:.1f} | Frames: {self.frame_count} | Dropped: {self.frames_dropped} | Clients: {len(self.clients)}")
             self.fps_start_time = current_time
 
     def export_history(self, filename=None):
@@ -336,8 +321,19 @@ class OptimizedTracker:
             filename = f"design_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
         
         try:
+            # Rebuild the full {**config, "pos-rot": ...} records once, here
+            export = {}
+            for marker_id, frames in self.design_history.items():
+                config = self.config['markers'].get(str(marker_id), self.config['default'])
+                export[str(marker_id)] = {
+                    str(frame): {
+                        **config,
+                        "pos-rot": {"x": x, "y": y, "z": z, "rx": rx, "ry": ry, "rz": rz, "s": 0.1}
+                    }
+                    for frame, (x, y, z, rx, ry, rz) in frames.items()
+                }
             with open(filename, 'w') as f:
-                json.dump(self.design_history, f, indent=2)
+                json.dump(export, f, indent=2)
             print(f"✅ Exported: {filename} ({self.frame_count} frames)")
         except Exception as e:
             print(f"❌ Export error: {e}")
@@ -348,22 +344,22 @@ class OptimizedTracker:
         try:
             await websocket.wait_closed()
         finally:
-            self.clients.remove(websocket)
+            self.clients.discard(websocket)  # broadcast may have dropped it already
             print(f"❌ Client disconnected. Total: {len(self.clients)}")
 
     async def broadcast(self, data):
         if self.clients:
-            message = json.dumps(data)
-            disconnected = []
-            for client in self.clients:
-                try:
-                    await client.send(message)
-                except:
-                    disconnected.append(client)
+            # Text frame for the JSON.parse clients; markers are keyed by int id
+            message = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+            # Send to everyone concurrently so one slow client doesn't hold up the rest
+            clients = list(self.clients)
+            results = await asyncio.gather(*(client.send(message) for client in clients),
+                                           return_exceptions=True)
             
             # Clean up disconnected clients
-            for client in disconnected:
-                self.clients.discard(client)
+            for client, result in zip(clients, results):
+                if isinstance(result, Exception):
+                    self.clients.discard(client)
 
     async def main_loop(self):
         print("🚀 Starting optimized tracker...")
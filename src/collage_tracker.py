@@ -2,66 +2,313 @@ import cv2
 import numpy as np
 import asyncio
 import websockets
+from websockets import broadcast as ws_broadcast
 import json
+import orjson
 import time
-import threading
-from queue import Queue, Empty
+import os
+import signal
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+from scipy.spatial.transform import Rotation
+from queue import Empty, Full
 from datetime import datetime
 
-class OptimizedTracker:
-    def __init__(self, config_file='marker_config.json'):
-        # Camera Setup - optimized for speed
-        self.cap = cv2.VideoCapture(1, cv2.CAP_DSHOW)
-        
-        # Try different resolutions for speed vs accuracy
-        resolutions = [(320, 240), (424, 240), (640, 480)]
-        for width, height in resolutions:
-            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-            actual_w = self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-            actual_h = self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-            if actual_w == width and actual_h == height:
-                print(f"📷 Resolution set: {width}x{height}")
-                break
-        
-        # FPS optimization
-        self.cap.set(cv2.CAP_PROP_FPS, 90)
-        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Reduce buffer to minimize lag
-        actual_fps = self.cap.get(cv2.CAP_PROP_FPS)
-        print(f"🎯 Target FPS: 90, Actual: {actual_fps}")
+# Faster libuv-based event loop; uvloop has no Windows build, winloop does
+try:
+    import uvloop as fast_loop
+except ImportError:
+    try:
+        import winloop as fast_loop
+    except ImportError:
+        fast_loop = None
+
+MARKER_LENGTH = 0.05  # Marker side in metres
+MAX_MARKERS = 250  # DICT_6X6_250 ids
+FRAME_SLOTS = 3  # Shared frame ring, a slot is rewritten two frames after publishing
+# (metres, degrees) of summed per-marker change before history / clients see it
+HISTORY_THRESHOLDS = (0.015, 2.0)
+BROADCAST_THRESHOLDS = (0.005, 0.5)  # Lower for smooth display
+KEYFRAME_INTERVAL = 2.0  # Seconds between full-state broadcasts, deltas in between
+# Marker corners in ArUco's pose layout (y up, z out of the marker), as IPPE_SQUARE requires
+MARKER_OBJECT_POINTS = np.array([
+    [-0.025, 0.025, 0], [0.025, 0.025, 0],
+    [0.025, -0.025, 0], [-0.025, -0.025, 0]
+], dtype=np.float32)
+# Batched pose estimation only ships with opencv-contrib
+HAS_BATCH_POSE = hasattr(cv2.aruco, 'estimatePoseSingleMarkers')
+
+# Turns ArUco's y-up pose frame into the tracker's y-down marker frame
+MARKER_FRAME_FLIP = Rotation.from_euler('x', 180, degrees=True)
+
+def rvecs_to_euler(rvecs):
+    """Convert (N,3) Rodrigues vectors to (N,3) Euler angles in degrees"""
+    return (Rotation.from_rotvec(rvecs) * MARKER_FRAME_FLIP).as_euler('xyz', degrees=True)
+
+def deltas_exceed(deltas, pos_thr, rot_thr):
+    """True if any marker moved more than pos_thr metres or turned more than rot_thr degrees"""
+    if len(deltas['pos']) == 0:
+        return False
+    # Rotation is skipped when position already decides
+    return bool(deltas['pos'].max() > pos_thr or deltas['rot'].max() > rot_thr)
+
+def empty_markers():
+    """Marker payload with no detections"""
+    return {'ids': np.empty(0, dtype=np.int32), 'pos': np.empty((0, 3)), 'rot': np.empty((0, 3))}
+
+def open_camera(resolutions=((320, 240), (424, 240), (640, 480))):
+    """Open the webcam at the first resolution it accepts, optimized for speed"""
+    cap = cv2.VideoCapture(1, cv2.CAP_DSHOW)
+    
+    # Try different resolutions for speed vs accuracy
+    for width, height in resolutions:
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        actual_w = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+        actual_h = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        if actual_w == width and actual_h == height:
+            break
+    
+    # FPS optimization
+    cap.set(cv2.CAP_PROP_FPS, 90)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Reduce buffer to minimize lag
+    return cap
+
+def capture_process(shm_name, frame_shape, resolution, slot_times, latest_slot, frame_ready, running):
+    """Capture process - owns the camera and fills the shared frame slots"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is the parent's to handle
+    print("🎬 Capture process started")
+    cap = open_camera([resolution])
+    shm = SharedMemory(name=shm_name)
+    frame_slots = np.ndarray((FRAME_SLOTS, *frame_shape), dtype=np.uint8, buffer=shm.buf)
+    slot = 0
+    try:
+        while running.is_set():
+            # Decode straight into the shared slot, no per-frame allocation
+            buf = frame_slots[slot]
+            ret, frame = cap.read(buf)
+            if not ret or frame.shape != frame_shape:
+                continue
+            if frame is not buf:
+                buf[:] = frame  # Backend ignored the destination
+            
+            slot_times[slot] = time.time()
+            latest_slot.value = slot  # Publish only after the slot is fully written
+            frame_ready.set()
+            slot = (slot + 1) % FRAME_SLOTS  # read() blocks on the driver, no extra pacing needed
+    finally:
+        cap.release()
+        del frame_slots  # Release the view before closing the mapping
+        shm.close()
+
+class MarkerDetector:
+    """ArUco detection and pose estimation, built inside the detection process"""
+    def __init__(self, resolution, tracker_config):
+        width, height = resolution
+        opencv_threads = tracker_config.get('opencv_threads')
+        if opencv_threads is not None:
+            cv2.setNumThreads(opencv_threads)  # 1 can be faster on some AMD CPUs
         
-        self.clients = set()
-        self.load_config(config_file)
+        # Detection runs on a downscaled grayscale copy, corners are scaled back
+        self.detect_scale = tracker_config.get('detect_scale', 0.5)
+        self.detect_size = (int(width * self.detect_scale), int(height * self.detect_scale))
         
         # ArUco - optimized detector
         self.aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)
         detector_params = cv2.aruco.DetectorParameters()
-        # Speed optimizations
+        # Speed optimizations - two threshold passes (3, 7) on the downscaled image
         detector_params.adaptiveThreshWinSizeMin = 3
-        detector_params.adaptiveThreshWinSizeMax = 15
+        detector_params.adaptiveThreshWinSizeMax = 7
         detector_params.adaptiveThreshWinSizeStep = 4
-        detector_params.minMarkerPerimeterRate = 0.01
+        # Cull tiny candidate contours early; the upper bound stays loose since a 5 cm
+        # marker's perimeter rate is ~0.24 / z, so 4.0 keeps markers down to ~6 cm away
+        detector_params.minMarkerPerimeterRate = 0.03
         detector_params.maxMarkerPerimeterRate = 4.0
+        # Aruco3: coarse detection on a downsampled image, refine only real candidates
+        detector_params.useAruco3Detection = True
+        detector_params.minSideLengthCanonicalImg = 32
+        detector_params.minMarkerLengthRatioOriginalImg = 0.05
+        detector_params.cameraMotionSpeed = 0.1  # Static webcam
+        # Any of these can be tuned per setup from the config's tracker.detector section,
+        # e.g. a single pass with adaptiveThreshWinSizeMin = Max for a fixed marker distance
+        for name, value in tracker_config.get('detector', {}).items():
+            if not hasattr(detector_params, name):
+                print(f"❌ Unknown detector parameter: {name}")
+                continue
+            setattr(detector_params, name, value)
+            print(f"🔧 Detector {name} = {value}")
         self.detector = cv2.aruco.ArucoDetector(self.aruco_dict, detector_params)
         
         # Camera calibration - adjusted for resolution
-        width = self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-        height = self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
         self.camera_matrix = np.array([
             [width * 1.2, 0, width/2], 
             [0, height * 1.2, height/2], 
             [0, 0, 1]
         ], dtype=float)
         self.dist_coeffs = np.zeros((4,1))
+        if HAS_BATCH_POSE:
+            # Closed-form planar solver instead of the default iterative one
+            self.pose_params = cv2.aruco.EstimateParameters()
+            self.pose_params.solvePnPMethod = cv2.SOLVEPNP_IPPE_SQUARE
+        
+        # CUDA colour conversion when OpenCV is built with CUDA support
+        self.use_cuda = cv2.cuda.getCudaEnabledDeviceCount() > 0
+        if self.use_cuda:
+            # Pre-allocated device buffers, reused every frame
+            self.gpu_frame = cv2.cuda_GpuMat()
+            self.gpu_gray = cv2.cuda_GpuMat()
+            self.gpu_small = cv2.cuda_GpuMat()
+            print("⚡ CUDA enabled for grayscale conversion")
+        
+        # Otherwise try OpenCL through the transparent API (iGPU, AMD, ...)
+        self.use_opencl = not self.use_cuda and cv2.ocl.haveOpenCL()
+        if self.use_opencl:
+            cv2.ocl.setUseOpenCL(True)
+            self.umat_gray = cv2.UMat(height, width, cv2.CV_8UC1)  # Reused every frame
+            self.umat_small = cv2.UMat(self.detect_size[1], self.detect_size[0], cv2.CV_8UC1)
+            print("⚡ OpenCL enabled for grayscale conversion and downscaling")
+        elif not self.use_cuda:
+            # CPU fallback - reuse the same host buffers every frame
+            self.gray_buf = np.empty((height, width), dtype=np.uint8)
+            self.small_buf = np.empty((self.detect_size[1], self.detect_size[0]), dtype=np.uint8)
+
+    def detect_markers(self, frame):
+        # Convert to grayscale and downscale once, on the device when available
+        if self.use_cuda:
+            self.gpu_frame.upload(frame)
+            cv2.cuda.cvtColor(self.gpu_frame, cv2.COLOR_BGR2GRAY, self.gpu_gray)
+            cv2.cuda.resize(self.gpu_gray, self.detect_size, self.gpu_small, interpolation=cv2.INTER_AREA)
+            small = self.gpu_small.download()  # ArUco detection is CPU-only
+            corners, ids, _ = self.detector.detectMarkers(small)
+        elif self.use_opencl:
+            cv2.cvtColor(cv2.UMat(frame), cv2.COLOR_BGR2GRAY, self.umat_gray)
+            cv2.resize(self.umat_gray, self.detect_size, self.umat_small, interpolation=cv2.INTER_AREA)
+            # The detector copies its input to a CPU Mat anyway, so hand it the
+            # small ndarray and keep the UMat overload's outputs out of the picture
+            small = self.umat_small.get()
+            corners, ids, _ = self.detector.detectMarkers(small)
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, self.gray_buf)
+            cv2.resize(self.gray_buf, self.detect_size, self.small_buf, interpolation=cv2.INTER_AREA)
+            corners, ids, _ = self.detector.detectMarkers(self.small_buf)
+        if ids is None or len(ids) == 0:
+            return empty_markers()
+        
+        # Back to full-resolution pixels for pose estimation; small pixel i is
+        # centred on full-res (i + 0.5) * inv_scale - 0.5 after INTER_AREA
+        inv_scale = 1.0 / self.detect_scale
+        corners = tuple((c + 0.5) * inv_scale - 0.5 for c in corners)
+        
+        # Batch process all markers into struct-of-arrays, sorted by id so
+        # frames with the same markers line up row for row. An id can come back
+        # twice (two printed copies, a mis-decode) - keep its first detection
+        ids, rvecs, tvecs = self.estimate_poses(corners, ids.flatten())
+        ids, order = np.unique(ids, return_index=True)
+        return {
+            'ids': ids,
+            'pos': tvecs[order],
+            'rot': rvecs_to_euler(rvecs[order])
+        }
+
+    def estimate_poses(self, corners, ids):
+        """Pose every detected marker, returns (ids, rvecs, tvecs) with (N,3) vectors"""
+        if HAS_BATCH_POSE:
+            rvecs, tvecs, _ = cv2.aruco.estimatePoseSingleMarkers(
+                corners, MARKER_LENGTH, self.camera_matrix, self.dist_coeffs,
+                estimateParameters=self.pose_params
+            )
+            return ids, rvecs.reshape(-1, 3), tvecs.reshape(-1, 3)
+        
+        # Fallback for plain opencv-python builds
+        posed_ids, rvecs, tvecs = [], [], []
+        for marker_id, marker_corners in zip(ids, corners):
+            success, rvec, tvec = cv2.solvePnP(
+                MARKER_OBJECT_POINTS, marker_corners.reshape(-1, 2),
+                self.camera_matrix, self.dist_coeffs, flags=cv2.SOLVEPNP_IPPE_SQUARE
+            )
+            if success:
+                posed_ids.append(marker_id)
+                rvecs.append(rvec)
+                tvecs.append(tvec)
+        return (np.array(posed_ids, dtype=np.int32),
+                np.array(rvecs).reshape(-1, 3), np.array(tvecs).reshape(-1, 3))
+
+def detection_process(shm_name, frame_shape, resolution, tracker_config,
+                      slot_times, latest_slot, frame_ready, running, result_queue):
+    """Detection process - runs detection and pose math on its own core, outside our GIL"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is the parent's to handle
+    print("🔍 Detection process started")
+    detector = MarkerDetector(resolution, tracker_config)
+    shm = SharedMemory(name=shm_name)
+    frame_slots = np.ndarray((FRAME_SLOTS, *frame_shape), dtype=np.uint8, buffer=shm.buf)
+    try:
+        while running.is_set():
+            try:
+                if not frame_ready.wait(timeout=0.1):
+                    continue
+                frame_ready.clear()
+                slot = latest_slot.value
+                timestamp = slot_times[slot]
+                # Grayscale conversion is the only read of the slot, well before
+                # the capture process rewrites it two frames later
+                markers = detector.detect_markers(frame_slots[slot])
+                
+                # Put result with timestamp
+                try:
+                    result_queue.put_nowait({
+                        'timestamp': timestamp,
+                        'markers': markers,
+                        'processing_time': time.time() - timestamp
+                    })
+                except Full:
+                    pass  # Queue full, drop result
+                    
+            except Exception as e:
+                print(f"❌ Processing error: {e}")
+    finally:
+        result_queue.cancel_join_thread()  # Unread results must not hold up exit
+        del frame_slots  # Release the view before closing the mapping
+        shm.close()
+
+class OptimizedTracker:
+    def __init__(self, config_file='marker_config.json'):
+        # Camera Setup - probe the resolution here, the capture process owns the camera
+        cap = open_camera()
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        print(f"📷 Resolution set: {width}x{height}")
+        actual_fps = cap.get(cv2.CAP_PROP_FPS)
+        print(f"🎯 Target FPS: 90, Actual: {actual_fps}")
+        cap.release()
+        self.resolution = (width, height)
+        
+        self.clients = set()
+        self.load_config(config_file)
+        self.tracker_config = self.config.get('tracker', {})
+        
+        # Ring of frame slots shared by the capture and detection processes
+        self.frame_shape = (height, width, 3)
+        self.shm = SharedMemory(create=True, size=FRAME_SLOTS * height * width * 3)
+        self.slot_times = mp.RawArray('d', FRAME_SLOTS)  # Capture timestamp per slot
+        self.latest_slot = mp.RawValue('i', 0)
+        self.frame_ready = mp.Event()
+        self.workers_running = mp.Event()
         
-        # Threading setup
-        self.frame_queue = Queue(maxsize=2)  # Small queue to prevent lag buildup
-        self.result_queue = Queue(maxsize=10)
+        # Detection results, pickled back from the detection process
+        self.result_queue = mp.Queue(maxsize=10)
         self.running = False
         
-        # History tracking
-        self.design_history = {}
-        self.last_states = {}
+        # History tracking - streamed to disk, a config header then one JSON line per update
+        os.makedirs('design_histories', exist_ok=True)
+        self.history_file = f"design_histories/{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson"
+        self.history_out = open(self.history_file, 'wb', buffering=1 << 20)
+        self.history_out.write(orjson.dumps({'type': 'config', 'config': self.config},
+                                            option=orjson.OPT_APPEND_NEWLINE))
+        # What clients currently show, as an id-indexed [x, y, z, rx, ry, rz] table
+        self.last_poses = np.zeros((MAX_MARKERS, 6), dtype=np.float32)
+        self.last_present = np.zeros(MAX_MARKERS, dtype=bool)
+        self.pose_scratch = np.empty_like(self.last_poses)
+        self.next_keyframe = 0.0
         self.frame_count = 0
         self.fps_counter = 0
         self.fps_start_time = time.time()
@@ -83,152 +330,45 @@ class OptimizedTracker:
                 }
             }
 
-    def capture_thread(self):
-        """Dedicated thread for frame capture"""
-        print("🎬 Capture thread started")
-        while self.running:
-            ret, frame = self.cap.read()
-            if not ret:
-                continue
-                
-            # Drop old frames if queue is full
-            if self.frame_queue.full():
-                try:
-                    self.frame_queue.get_nowait()
-                except Empty:
-                    pass
-            
-            try:
-                self.frame_queue.put_nowait((time.time(), frame))
-            except:
-                pass  # Queue full, drop frame
-            
-            time.sleep(0.005)  # Small delay to prevent overwhelming
-
-    def process_thread(self):
-        """Dedicated thread for marker detection"""
-        print("🔍 Processing thread started")
-        while self.running:
-            try:
-                timestamp, frame = self.frame_queue.get(timeout=0.1)
-                markers = self.detect_markers(frame)
-                
-                # Put result with timestamp
-                try:
-                    self.result_queue.put_nowait({
-                        'timestamp': timestamp,
-                        'markers': markers,
-                        'processing_time': time.time() - timestamp
-                    })
-                except:
-                    pass  # Queue full, drop result
-                    
-            except Empty:
-                continue
-            except Exception as e:
-                print(f"❌ Processing error: {e}")
-
-    def detect_markers(self, frame):
-        # Convert to grayscale once
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        corners, ids, _ = self.detector.detectMarkers(gray)
-        markers = {}
-        
-        if ids is not None:
-            # Batch process all markers
-            object_points = np.array([
-                [-0.025, -0.025, 0], [0.025, -0.025, 0], 
-                [0.025, 0.025, 0], [-0.025, 0.025, 0]
-            ], dtype=np.float32)
-            
-            for i, marker_id in enumerate(ids.flatten()):
-                try:
-                    success, rvec, tvec = cv2.solvePnP(
-                        object_points, corners[i].reshape(-1, 2), 
-                        self.camera_matrix, self.dist_coeffs
-                    )
-                    
-                    if success:
-                        # Fast rotation conversion
-                        R, _ = cv2.Rodrigues(rvec.flatten())
-                        markers[int(marker_id)] = {
-                            'id': int(marker_id),
-                            'position': {
-                                'x': float(tvec[0]), 
-                                'y': float(tvec[1]), 
-                                'z': float(tvec[2])
-                            },
-                            'rotation': {
-                                'x': float(np.arctan2(R[2,1], R[2,2]) * 180/np.pi),
-                                'y': float(np.arctan2(-R[2,0], np.sqrt(R[2,1]**2 + R[2,2]**2)) * 180/np.pi),
-                                'z': float(np.arctan2(R[1,0], R[0,0]) * 180/np.pi)
-                            }
-                        }
-                except Exception as e:
-                    print(f"❌ Marker {marker_id} processing error: {e}")
-                    continue
+    def _classify_change(self, markers):
+        """Return (update_history, broadcast, deltas) from one delta pass against what clients show"""
+        ids = markers['ids']
+        # Computed up front, broadcast_markers reuses them for the delta packet
+        deltas = self.pose_deltas(markers)
+        # Ids are unique (deduplicated on detection), so same count + all known means the same set
+        if len(ids) != np.count_nonzero(self.last_present) or not self.last_present[ids].all():
+            return True, True, deltas
         
-        return markers
+        return (deltas_exceed(deltas, *HISTORY_THRESHOLDS),
+                deltas_exceed(deltas, *BROADCAST_THRESHOLDS), deltas)
 
-    def should_update_history(self, markers):
-        if len(markers) != len(self.last_states):
-            return True
-        
-        for marker_id, data in markers.items():
-            if marker_id not in self.last_states:
-                return True
-            
-            last = self.last_states[marker_id]
-            # Increased thresholds for fewer updates
-            pos_change = sum(abs(data['position'][k] - last['position'][k]) for k in ['x', 'y', 'z'])
-            rot_change = sum(abs(data['rotation'][k] - last['rotation'][k]) for k in ['x', 'y', 'z'])
-            
-            if pos_change > 0.015 or rot_change > 2.0:  # Higher thresholds
-                return True
-        return False
+    def pose_deltas(self, markers):
+        """Per-marker summed |delta| against what clients currently show"""
+        last = self.last_poses[markers['ids']]
+        return {
+            'pos': np.abs(markers['pos'] - last[:, :3]).sum(axis=1),
+            'rot': np.abs(markers['rot'] - last[:, 3:]).sum(axis=1)
+        }
 
-    def should_broadcast(self, markers):
-        """Separate check for broadcasting - can be more frequent than history"""
-        if len(markers) != len(self.last_states):
-            return True
-        
-        for marker_id, data in markers.items():
-            if marker_id not in self.last_states:
-                return True
-            
-            last = self.last_states[marker_id]
-            pos_change = sum(abs(data['position'][k] - last['position'][k]) for k in ['x', 'y', 'z'])
-            rot_change = sum(abs(data['rotation'][k] - last['rotation'][k]) for k in ['x', 'y', 'z'])
-            
-            if pos_change > 0.005 or rot_change > 0.5:  # Lower thresholds for smooth display
-                return True
-        return False
+    def set_last_states(self, markers):
+        ids = markers['ids']
+        self.last_present[:] = False
+        self.last_present[ids] = True
+        self.last_poses[ids, :3] = markers['pos']
+        self.last_poses[ids, 3:] = markers['rot']
 
     def update_history(self, markers):
-        all_ids = set(markers.keys()) | set(self.last_states.keys())
+        # Markers missing from this frame keep their last broadcast pose
+        poses = self.pose_scratch
+        np.copyto(poses, self.last_poses)
+        poses[markers['ids'], :3] = markers['pos']
+        poses[markers['ids'], 3:] = markers['rot']
+        ids = np.union1d(np.flatnonzero(self.last_present), markers['ids'])
         
-        for marker_id in all_ids:
-            marker_id_str = str(marker_id)
-            if marker_id_str not in self.design_history:
-                self.design_history[marker_id_str] = {}
-            
-            data = markers.get(marker_id, self.last_states.get(marker_id, {
-                'position': {'x': 0, 'y': 0, 'z': 0},
-                'rotation': {'x': 0, 'y': 0, 'z': 0}
-            }))
-            
-            config = self.config['markers'].get(marker_id_str, self.config['default'])
-            
-            entry = {
-                **config,
-                "pos-rot": {
-                    "x": data['position']['x'], "y": data['position']['y'], "z": data['position']['z'],
-                    "rx": data['rotation']['x'], "ry": data['rotation']['y'], "rz": data['rotation']['z'],
-                    "s": 0.1
-                }
-            }
-            
-            self.design_history[marker_id_str][str(self.frame_count)] = entry
+        self.history_out.write(orjson.dumps(
+            {'f': self.frame_count, 'ids': ids, 'p': poses[ids, :3], 'r': poses[ids, 3:]},
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE
+        ))
         
         self.frame_count += 1
 
@@ -241,14 +381,11 @@ class OptimizedTracker:
             print(f"📊 Processing FPS: {fps:.1f} | Frames: {self.frame_count} | Clients: {len(self.clients)}")
             self.fps_start_time = current_time
 
-    def export_history(self, filename=None):
-        if not filename:
-            filename = f"design_histories/{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        
+    def close_history(self):
+        # Lines are already on disk, only the write buffer is left to flush
         try:
-            with open(filename, 'w') as f:
-                json.dump(self.design_history, f, indent=2)
-            print(f"✅ Exported: {filename} ({self.frame_count} frames)")
+            self.history_out.close()
+            print(f"✅ Exported: {self.history_file} ({self.frame_count} frames)")
         except Exception as e:
             print(f"❌ Export error: {e}")
 
@@ -256,57 +393,99 @@ class OptimizedTracker:
         self.clients.add(websocket)
         print(f"🔗 Client connected. Total: {len(self.clients)}")
         try:
+            # Deltas only make sense on top of the current state
+            await websocket.send(orjson.dumps(self.keyframe(), option=orjson.OPT_SERIALIZE_NUMPY))
             await websocket.wait_closed()
         finally:
-            self.clients.remove(websocket)
+            self.clients.discard(websocket)
             print(f"❌ Client disconnected. Total: {len(self.clients)}")
 
-    async def broadcast(self, data):
+    def keyframe(self, processing_time=0.0):
+        """Full-state message built from what clients should currently show"""
+        ids = np.flatnonzero(self.last_present)
+        return {
+            'type': 'tracking_update',
+            'markers': {'ids': ids, 'pos': self.last_poses[ids, :3], 'rot': self.last_poses[ids, 3:]},
+            'timestamp': time.time(),
+            'processing_time': processing_time
+        }
+
+    def broadcast_markers(self, markers, deltas, processing_time):
+        """Send only markers that moved or vanished, with a periodic full keyframe to resync"""
+        now = time.time()
+        if now >= self.next_keyframe:
+            self.next_keyframe = now + KEYFRAME_INTERVAL
+            self.set_last_states(markers)
+            self.broadcast(self.keyframe(processing_time))
+            return
+        
+        ids = markers['ids']
+        # New markers and ones past the broadcast thresholds both just get their pose set
+        changed = (~self.last_present[ids] | (deltas['pos'] > BROADCAST_THRESHOLDS[0]) |
+                   (deltas['rot'] > BROADCAST_THRESHOLDS[1]))
+        present = np.zeros(MAX_MARKERS, dtype=bool)
+        present[ids] = True
+        gone = np.flatnonzero(self.last_present & ~present)
+        
+        upd = {'ids': ids[changed], 'pos': markers['pos'][changed], 'rot': markers['rot'][changed]}
+        self.broadcast({
+            'type': 'tracking_delta',
+            'upd': upd,
+            'del': gone,
+            'timestamp': now,
+            'processing_time': processing_time
+        })
+        # Unchanged markers keep the pose clients already have
+        self.last_present[gone] = False
+        self.last_present[upd['ids']] = True
+        self.last_poses[upd['ids'], :3] = upd['pos']
+        self.last_poses[upd['ids'], 3:] = upd['rot']
+
+    def broadcast(self, data):
         if self.clients:
-            message = json.dumps(data)
-            disconnected = []
-            for client in self.clients:
-                try:
-                    await client.send(message)
-                except:
-                    disconnected.append(client)
-            
-            # Clean up disconnected clients
-            for client in disconnected:
-                self.clients.discard(client)
+            # bytes, sent as a binary frame
+            message = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+            # Writes the same frame to every open connection without awaiting;
+            # closed or closing clients are skipped
+            ws_broadcast(self.clients, message)
 
     async def main_loop(self):
         print("🚀 Starting optimized tracker...")
         print("Press Ctrl+C to stop and export")
         
-        # Start worker threads
+        # Capture and detection run in their own interpreters so they never contend for our GIL
         self.running = True
-        capture_thread = threading.Thread(target=self.capture_thread, daemon=True)
-        process_thread = threading.Thread(target=self.process_thread, daemon=True)
+        self.workers_running.set()
+        capture = mp.Process(target=capture_process, daemon=True, args=(
+            self.shm.name, self.frame_shape, self.resolution,
+            self.slot_times, self.latest_slot, self.frame_ready, self.workers_running
+        ))
+        detection = mp.Process(target=detection_process, daemon=True, args=(
+            self.shm.name, self.frame_shape, self.resolution, self.tracker_config,
+            self.slot_times, self.latest_slot, self.frame_ready, self.workers_running,
+            self.result_queue
+        ))
         
-        capture_thread.start()
-        process_thread.start()
+        capture.start()
+        detection.start()
+        loop = asyncio.get_running_loop()
         
         try:
             while self.running:
                 try:
-                    # Get latest processing result
-                    result = self.result_queue.get(timeout=0.1)
+                    # Wait for the next result off the event loop; this paces the
+                    # loop instead of a sleep and keeps websocket IO flowing meanwhile
+                    result = await loop.run_in_executor(None, self.result_queue.get, True, 0.1)
                     markers = result['markers']
+                    update_history, broadcast, deltas = self._classify_change(markers)
                     
                     # Update history less frequently
-                    if self.should_update_history(markers):
+                    if update_history:
                         self.update_history(markers)
                     
                     # Broadcast more frequently for smooth display
-                    if self.should_broadcast(markers):
-                        await self.broadcast({
-                            'type': 'tracking_update',
-                            'markers': markers,
-                            'timestamp': time.time(),
-                            'processing_time': result['processing_time']
-                        })
-                        self.last_states = markers.copy()
+                    if broadcast:
+                        self.broadcast_markers(markers, deltas, result['processing_time'])
                     
                     self.calculate_fps()
                     
@@ -314,23 +493,29 @@ class OptimizedTracker:
                     continue
                 except KeyboardInterrupt:
                     break
-                
-                await asyncio.sleep(0.001)  # Minimal delay
-                
+                    
         except KeyboardInterrupt:
             pass
         finally:
             print("\n🛑 Shutting down...")
             self.running = False
-            self.export_history()
-            self.cap.release()
+            self.workers_running.clear()
+            capture.join(timeout=2)
+            detection.join(timeout=2)
+            self.close_history()
+            self.shm.close()
+            self.shm.unlink()
 
     async def start(self, host='localhost', port=8765):
-        server = await websockets.serve(self.handle_client, host, port)
+        # No per-message deflate, so broadcast frames are never re-encoded per client
+        server = await websockets.serve(self.handle_client, host, port, compression=None)
         print(f"🌐 WebSocket server running on ws://{host}:{port}")
         await self.main_loop()
 
 if __name__ == "__main__":
+    if fast_loop:
+        asyncio.set_event_loop_policy(fast_loop.EventLoopPolicy())
+        print(f"⚡ Using {fast_loop.__name__} event loop")
     tracker = OptimizedTracker()
     try:
         asyncio.run(tracker.start())
@@ -89,26 +89,24 @@ export class MarkerManager {
         checkTime();
     }
 
-    updateMarkerPosition(marker, data) {
-        const id = data.id;
-        
+    updateMarkerPosition(marker, id, [x, y, z], [rx, ry, rz]) {
         // Set target positions for interpolation
         this.targetPositions.set(id, {
-            x: -data.position.x * 3200 + 200,
-            y: data.position.y * 1500 + 250,
-            z: -data.position.z * 100
+            x: -x * 3200 + 200,
+            y: y * 1500 + 250,
+            z: -z * 100
         });
         
         this.targetRotations.set(id, {
-            x: data.rotation.x * Math.PI/180,
-            y: data.rotation.y * Math.PI/180,
-            z: data.rotation.z * Math.PI/180
+            x: rx * Math.PI/180,
+            y: ry * Math.PI/180,
+            z: rz * Math.PI/180
         });
         
         marker.visible = true;
         
         // Volume control with debouncing
-        this.updateMarkerVolume(marker, data);
+        this.updateMarkerVolume(marker, id, rz);
 
         // Cleanup selection if marker becomes invisible
         if (!marker.visible && this.viewer.midi.selectedMarkers.has(id)) {
@@ -116,10 +114,10 @@ export class MarkerManager {
         }
     }
 
-    updateMarkerVolume(marker, data) {
-        const player = this.players.get(data.id);
+    updateMarkerVolume(marker, id, rz) {
+        const player = this.players.get(id);
         if (player?.setVolume) {
-            const rotZ = Math.abs(data.rotation.z) % 360;
+            const rotZ = Math.abs(rz) % 360;
             const volume = Math.round(rotZ / 360 * 50); // Max 50% volume
             if (!marker.lastVolume || Math.abs(marker.lastVolume - volume) >= 10) {
                 player.setVolume(volume);
@@ -3,11 +3,14 @@ export class WebSocketManager {
         this.viewer = viewer;
         this.ws = null;
         this.reconnectTimeout = 3000;
+        this.decoder = new TextDecoder();
+        this.visibleIds = new Set(); // Markers in the tracker's current state
     }
 
     connect() {
         try {
             this.ws = new WebSocket('ws://localhost:8765');
+            this.ws.binaryType = 'arraybuffer'; // Tracker sends JSON as binary frames
             
             this.ws.onopen = () => {
                 this.viewer.ui.updateConnectionStatus(true);
@@ -34,10 +37,13 @@ export class WebSocketManager {
 
     handleMessage(event) {
         try {
-            const data = JSON.parse(event.data);
+            const text = typeof event.data === 'string' ? event.data : this.decoder.decode(event.data);
+            const data = JSON.parse(text);
             
             if (data.type === 'tracking_update') {
                 this.processTrackingUpdate(data);
+            } else if (data.type === 'tracking_delta') {
+                this.processTrackingDelta(data);
             }
         } catch (err) {
             console.error('❌ Message parsing error:', err);
@@ -45,18 +51,31 @@ export class WebSocketManager {
     }
 
     processTrackingUpdate(data) {
-        const markers = data.markers || {};
-        
-        // Update markers
-        Object.entries(markers).forEach(([id, markerData]) => {
-            id = parseInt(id);
+        // Full state (keyframe) - replaces whatever we had
+        this.visibleIds.clear();
+        this.applyMarkers(data.markers);
+        this.updateStats(data);
+    }
+
+    processTrackingDelta(data) {
+        // Only markers that moved or appeared, plus the ids that vanished
+        this.applyMarkers(data.upd);
+        (data.del || []).forEach(id => this.visibleIds.delete(id));
+        this.updateStats(data);
+    }
+
+    applyMarkers({ ids = [], pos = [], rot = [] } = {}) {
+        // Struct-of-arrays: row i of pos/rot belongs to ids[i]
+        ids.forEach((id, i) => {
             const marker = this.viewer.markerManager.addMarker(id);
-            this.viewer.markerManager.updateMarkerPosition(marker, markerData);
+            this.viewer.markerManager.updateMarkerPosition(marker, id, pos[i], rot[i]);
+            this.visibleIds.add(id);
         });
-        
-        // Update UI stats
+    }
+
+    updateStats(data) {
         this.viewer.ui.updateMarkerStats(
-            Object.keys(markers).length,
+            this.visibleIds.size,
             this.viewer.markerManager.getPlayerCount()
         );
         